@@ -1,10 +1,19 @@
-import os, json, time, re
+import os, sys, json, time, re, atexit, hashlib, threading, zlib, base64, functools
 from typing import Dict, List, Tuple
+from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson  # быстрее stdlib json на больших отчётах; без него — fallback
+except ImportError:
+    orjson = None
 from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
 
 
@@ -21,6 +30,36 @@ CHAT_IDS = [cid for cid in (TG_CHAT_ID_1, TG_CHAT_ID_2) if cid]
 GIST_ID    = os.environ["GIST_ID"]
 GIST_TOKEN = os.environ["GIST_TOKEN"]
 GIST_FILENAME = os.getenv("GIST_FILENAME", "keitaro_favourite_state.json")
+# локальная копия стейта: быстрый путь без GitHub, гист — холодное хранилище
+LOCAL_STATE_PATH = os.getenv("LOCAL_STATE_PATH", f"/tmp/{GIST_FILENAME}")
+
+# куки Keitaro + снятый XHR отчёта: пока сессия жива, отчёт берём прямым HTTP без браузера
+STORAGE_STATE_PATH = os.getenv("STORAGE_STATE_PATH", "/tmp/kt_storage_state.json")
+REPORT_REQUEST_PATH = os.getenv("REPORT_REQUEST_PATH", "/tmp/kt_report_request.json")
+# XHR отчёта, скопированный из DevTools (URL + JSON-тело) — тогда снятый браузером не нужен
+REPORT_API_URL = os.getenv("REPORT_API_URL", "")
+REPORT_API_BODY = os.getenv("REPORT_API_BODY", "")
+# 1 — дублировать сессию в гист (для одноразовых прогонов Actions, где /tmp пустой).
+# В гисте окажутся куки админки — включать только для секретного гиста.
+SESSION_IN_GIST = (os.getenv("SESSION_IN_GIST", "0") == "1")
+SESSION_GIST_FILENAME = os.getenv("SESSION_GIST_FILENAME", f"{os.path.splitext(GIST_FILENAME)[0]}.session.json")
+# ключ Admin API Keitaro — отчёт строим прямым REST (admin_api/v1/report/build), без логина и браузера
+KEITARO_API_KEY = os.getenv("KEITARO_API_KEY", "")
+# тело report/build (JSON) с теми же фильтрами, что у отчёта PAGE_URL; без него API-путь не включается
+KEITARO_REPORT_BODY = os.getenv("KEITARO_REPORT_BODY", "")
+# каталог профиля Chromium (launch_persistent_context) — вместо storage_state держит и HTTP-кэш.
+# route-фильтр в этом режиме не ставится (с ним Playwright отключает кэш): бандлы админки
+# берутся с диска, но шрифты/стили/трекеры грузятся. Пусто — обычный контекст из STORAGE_STATE_PATH
+BROWSER_PROFILE_DIR = os.getenv("BROWSER_PROFILE_DIR", "")
+# 0 — только прямой HTTP, Chromium не поднимаем вообще (нужен живой STORAGE_STATE_PATH)
+USE_BROWSER = (os.getenv("USE_BROWSER", "1") != "0")
+
+TG_SEND_URL = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage"
+GIST_URL = f"https://api.github.com/gists/{GIST_ID}"
+GIST_HEADERS = {
+    "Authorization": f"Bearer {GIST_TOKEN}",
+    "Accept": "application/vnd.github+json"
+}
 
 # Киев для reset
 KYIV_TZ = ZoneInfo(os.getenv("KYIV_TZ", "Europe/Kyiv"))
@@ -28,13 +67,56 @@ EPS = 0.0001
 
 DEBUG = (os.getenv("DEBUG_LOG", "0") == "1")
 
+# >0 — работаем демоном (тик раз в N сек, браузер тёплый); 0 — один прогон (cron/Actions)
+LOOP_INTERVAL = int(os.getenv("LOOP_INTERVAL", "0") or 0)
+
+# пересоздаём контекст раз в N тиков / M секунд — Playwright держит response-объекты до его закрытия
+CONTEXT_MAX_USES = int(os.getenv("CONTEXT_MAX_USES", "20") or 20)
+CONTEXT_MAX_AGE = float(os.getenv("CONTEXT_MAX_AGE", "1800") or 1800)
+
 # ВАЖНО: домен берём из PAGE_URL, чтобы не было треша с куками/сессией
 pu = urlparse(PAGE_URL)
 BASE_URL = f"{pu.scheme}://{pu.netloc}".rstrip("/")
 
 
+# ================= HTTP =================
+# GitHub: 5xx — короткий бэкофф; после попыток отдаём последний ответ как есть.
+# GET и тот же PATCH-боди повторять безопасно. 429/403 rate limit тут НЕ ретраим —
+# их ждёт _github_rate_wait по X-RateLimit-Reset / Retry-After
+HTTP_RETRY = Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=[500, 502, 503, 504],
+    allowed_methods=["GET", "PATCH"],
+    raise_on_status=False,
+)
+# Telegram: sendMessage не идемпотентен — 5xx/таймаут чтения после доставки дал бы дубль алерта.
+# Повторяем только несостоявшееся соединение (запрос точно не ушёл)
+TG_RETRY = Retry(
+    total=3,
+    connect=3,
+    read=0,
+    status=0,
+    other=0,
+    backoff_factor=0.3,
+    raise_on_status=False,
+)
+
+def _http_session(headers: Dict, retry: Retry) -> requests.Session:
+    # keep-alive пул: без нового TLS-хендшейка на каждый вызов
+    s = requests.Session()
+    s.headers.update({"User-Agent": "kt_bot1", **headers})
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return s
+
+# по сессии на хост: токен гиста висит на сессии GitHub и не уходит в Telegram
+TG_SESSION = _http_session({}, TG_RETRY)
+GH_SESSION = _http_session(GIST_HEADERS, HTTP_RETRY)
+
+
 # ================= TG + LOGGER =================
-LOG_BUF: List[str] = []
+# в TG уходят только последние 45 строк — старше держать незачем (важно в loop-режиме)
+LOG_BUF: deque = deque(maxlen=45)
 
 def _ts() -> str:
     return datetime.now(KYIV_TZ).strftime("%H:%M:%S")
@@ -45,194 +127,800 @@ def log(msg: str):
     if DEBUG:
         LOG_BUF.append(line)
 
-def tg_send(text: str, markdown: bool = True):
-    if not CHAT_IDS:
-        return
-    for cid in CHAT_IDS:
+def debug(msg: str, *args):
+    # %-форматирование только при DEBUG — в проде аргументы не склеиваются вовсе
+    if DEBUG:
+        log("[DEBUG] " + (msg % args if args else msg))
+
+class TokenBucket:
+    """Простой token bucket: take() блокирует, пока не освободится токен."""
+
+    def __init__(self, rate: float, per: float = 1.0):
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / per
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.fill_rate)
+                self.ts = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+# лимит Telegram на бота — 30 сообщений/с; сами себя притормаживаем, а не ловим 429
+TG_BUCKET = TokenBucket(30, 1.0)
+# и ~1 сообщение/с в один чат: пачка чанков в чат идёт с шагом в секунду
+_TG_CHAT_BUCKETS: Dict[str, TokenBucket] = {}
+_TG_CHAT_LOCK = threading.Lock()
+
+def _chat_bucket(cid: str) -> TokenBucket:
+    with _TG_CHAT_LOCK:
+        b = _TG_CHAT_BUCKETS.get(cid)
+        if b is None:
+            b = _TG_CHAT_BUCKETS[cid] = TokenBucket(1, 1.0)
+        return b
+
+TG_MAX_ATTEMPTS = 3
+TG_RETRY_WAIT_MAX = 30.0
+
+def _tg_post(cid: str, text: str, markdown: bool):
+    payload = {
+        "chat_id": cid,
+        "text": text,
+        "parse_mode": "Markdown" if markdown else None,
+        "disable_web_page_preview": True
+    }
+    chat_bucket = _chat_bucket(cid)
+    for _ in range(TG_MAX_ATTEMPTS):
+        chat_bucket.take()
+        TG_BUCKET.take()
         try:
-            requests.post(
-                f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage",
-                json={
-                    "chat_id": cid,
-                    "text": text,
-                    "parse_mode": "Markdown" if markdown else None,
-                    "disable_web_page_preview": True
-                },
-                timeout=20
-            )
+            r = TG_SESSION.post(TG_SEND_URL, json=payload, timeout=20)
+        except Exception as e:
+            # только тип: в тексте исключения бывает URL с токеном бота
+            log(f"TG send failed ({cid}): {type(e).__name__}")
+            return
+        if r.status_code != 429:
+            if not r.ok:
+                log(f"TG send HTTP {r.status_code} ({cid})")
+            return
+        # 429: Telegram говорит, сколько ждать, — ждём ровно столько и шлём снова
+        try:
+            wait = float(json_loads(r.content)["parameters"]["retry_after"])
         except Exception:
-            pass
+            wait = 1.0
+        # flood control просит и сотни секунд — столько тик (и job в Actions) не висит
+        if wait > TG_RETRY_WAIT_MAX:
+            log(f"TG 429 ({cid}): retry_after={wait:.0f}s > {TG_RETRY_WAIT_MAX:.0f}s -> give up")
+            return
+        log(f"TG 429 ({cid}) -> retry in {wait:.0f}s")
+        time.sleep(wait)
+    log(f"TG send gave up ({cid})")
+
+def _tg_post_all(cid: str, texts: List[str], markdown: bool):
+    # внутри одного чата порядок сообщений важен — шлём по очереди
+    for t in texts:
+        _tg_post(cid, t, markdown)
+
+# пул живёт весь процесс: в loop-режиме потоки не создаются заново на каждый тик
+_TG_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tg")
+
+def tg_send_many(texts: List[str], markdown: bool = True):
+    if not CHAT_IDS or not texts:
+        return
+    if len(CHAT_IDS) == 1:
+        _tg_post_all(CHAT_IDS[0], texts, markdown)
+        return
+    # чаты независимы — шлём параллельно, латентность = max(RTT), а не сумма
+    futs = [_TG_POOL.submit(_tg_post_all, cid, texts, markdown) for cid in CHAT_IDS]
+    for f in as_completed(futs):
+        try:
+            f.result()
+        except Exception as e:
+            log(f"TG worker failed: {type(e).__name__}")
+
+def tg_send(text: str, markdown: bool = True):
+    tg_send_many([text], markdown)
+
+# лимит Telegram — 4096 символов; берём с запасом: эмодзи в заголовках алертов
+# Telegram считает в UTF-16 (по 2 единицы), а Python — по одному code point
+TG_MAX_LEN = 4000
+
+class AlertBatcher:
+    """Копит алерты тика и шлёт их минимумом сообщений (не длиннее TG_MAX_LEN)."""
+
+    def __init__(self, markdown: bool = True):
+        self.markdown = markdown
+        self.blocks: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def add(self, msg: str):
+        self.blocks.append(msg)
+
+    def chunks(self) -> List[str]:
+        # режем только по границам "\n\n", чтобы алерт не разорвало посередине;
+        # копим куски списком и склеиваем один раз на сообщение
+        out: List[str] = []
+        cur: List[str] = []
+        size = 0
+        for b in self.blocks:
+            b = b[:TG_MAX_LEN]
+            if cur and size + 2 + len(b) > TG_MAX_LEN:
+                out.append("\n\n".join(cur))
+                cur, size = [], 0
+            size += len(b) + (2 if cur else 0)
+            cur.append(b)
+        if cur:
+            out.append("\n\n".join(cur))
+        return out
+
+    def flush(self) -> int:
+        chunks = self.chunks()
+        tg_send_many(chunks, markdown=self.markdown)
+        self.blocks = []
+        return len(chunks)
+
+def alert_text(title: str, r, *lines: str) -> str:
+    # один join на алерт вместо промежуточных строк заголовка
+    return "\n".join((
+        title,
+        f"Campaign: {r.campaign}",
+        f"Country: {r.country}",
+        f"External: {r.external_id}",
+        f"Creative: {r.creative_id}",
+        *lines,
+    ))
 
 def flush_debug_to_tg():
     if not DEBUG or not LOG_BUF:
         return
-    # последние 45 строк
-    chunk = "\n".join(LOG_BUF[-45:])
+    chunk = "\n".join(LOG_BUF)
     tg_send("🧪 *DEBUG LOG*\n```\n" + chunk + "\n```", markdown=True)
+    # в loop-режиме следующий тик шлёт только свои строки, а не хвост прошлых
+    LOG_BUF.clear()
 
 
 # ================= utils =================
 def kyiv_today_str() -> str:
     return datetime.now(KYIV_TZ).strftime("%Y-%m-%d")
 
+def json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def json_dumps(obj, sort_keys: bool = False) -> str:
+    # компактно и в UTF-8 (как ensure_ascii=False), без indent — это лишние байты по сети
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys)
+
+def json_bytes(obj) -> bytes:
+    # тело запроса: orjson сразу отдаёт UTF-8 bytes — без лишних .decode()/.encode()
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json_dumps(obj).encode("utf-8")
+
+# "$1,234.50" / "1 234" из UI-форматированных полей: одна translate вместо цепочки replace
+_NUM_STRIP = str.maketrans("", "", "$, \t\u00a0")
+
 def as_float(v):
+    if v is None:
+        return 0.0
+    t = type(v)
+    if t is float:
+        return v
+    if t is int:
+        return float(v)
     try:
+        if t is str:
+            v = v.translate(_NUM_STRIP)
         return float(v or 0)
-    except:
+    except (TypeError, ValueError):
         return 0.0
 
 def as_int(v):
+    if v is None:
+        return 0
+    if type(v) is int:
+        return v
     try:
-        return int(float(v or 0))
-    except:
+        return int(as_float(v))
+    except (ValueError, OverflowError):
+        # int(float("inf")) / int(float("nan"))
         return 0
 
+@functools.lru_cache(maxsize=4096)
+def _fmt_cents(x: float) -> str:
+    return "$" + format(x, ",.2f")
+
+def fmt_money(x: float) -> str:
+    # округляем до центов до кэша, иначе 0.1+0.2 и 0.3 — разные ключи
+    return _fmt_cents(round(x, 2))
+
 
 # ================= state (Gist) =================
+# ETag последнего ответа гиста: на 304 GitHub не шлёт тело и не тратит rate limit
+_GIST_CACHE: Dict = {"etag": None, "state": None, "hash": None}
+
+def state_blob(state: Dict) -> str:
+    return json_dumps(state, sort_keys=True)
+
+def state_hash(state: Dict) -> str:
+    return hashlib.blake2b(state_blob(state).encode("utf-8"), digest_size=16).hexdigest()
+
+# большой стейт жмём: zlib+base64 под префиксом (GitHub режет содержимое файлов > 1 МБ в GET)
+STATE_COMPRESS_OVER = 100_000
+STATE_ZLIB_PREFIX = "zlib:"
+
+def encode_state(state: Dict) -> str:
+    raw = json_dumps(state)
+    if len(raw) <= STATE_COMPRESS_OVER:
+        return raw
+    return STATE_ZLIB_PREFIX + base64.b64encode(zlib.compress(raw.encode("utf-8"), 6)).decode("ascii")
+
+def decode_state(content: str) -> Dict:
+    if content.startswith(STATE_ZLIB_PREFIX):
+        return json_loads(zlib.decompress(base64.b64decode(content[len(STATE_ZLIB_PREFIX):])))
+    return json_loads(content)
+
+def _remember_state(state: Dict, etag):
+    _GIST_CACHE.update(etag=etag, state=state, hash=state_hash(state))
+
+def _read_json_file(path: str):
+    try:
+        with open(path, "rb") as f:
+            return json_loads(f.read())
+    except Exception:
+        return None
+
+def _load_local_state() -> Tuple:
+    # {"etag": ..., "state": {...}}; всё прочее (в т.ч. голый стейт без etag) — промах кэша
+    data = _read_json_file(LOCAL_STATE_PATH)
+    if not isinstance(data, dict) or not data.get("etag") or not isinstance(data.get("state"), dict):
+        return None, None
+    return data["etag"], data["state"]
+
+def _save_local_state(state: Dict, etag):
+    try:
+        with open(LOCAL_STATE_PATH, "w", encoding="utf-8") as f:
+            f.write(json_dumps({"etag": etag, "state": state}))
+    except Exception as e:
+        log(f"Local state not written: {e!r}")
+
 def load_state() -> Dict:
-    url = f"https://api.github.com/gists/{GIST_ID}"
-    r = requests.get(url, headers={
-        "Authorization": f"Bearer {GIST_TOKEN}",
-        "Accept": "application/vnd.github+json"
-    }, timeout=30)
+    if _GIST_CACHE["state"] is None:
+        etag, local = _load_local_state()
+        if local is not None:
+            # локальную копию сверяем с гистом по ETag: 304 — берём её, 200 — гист менял кто-то ещё
+            _remember_state(local, etag)
+
+    headers = {}
+    if _GIST_CACHE["etag"] and _GIST_CACHE["state"] is not None:
+        headers["If-None-Match"] = _GIST_CACHE["etag"]
+    for _ in range(2):
+        r = GH_SESSION.get(GIST_URL, headers=headers, timeout=30)
+        if not _github_rate_wait(r):
+            break
+    if r.status_code == 304:
+        log("Gist not modified (304)")
+        return _GIST_CACHE["state"]
     if r.status_code == 200:
-        files = r.json().get("files", {})
+        files = json_loads(r.content).get("files", {})
         if GIST_FILENAME in files and "content" in files[GIST_FILENAME]:
             try:
-                return json.loads(files[GIST_FILENAME]["content"])
+                state = decode_state(files[GIST_FILENAME]["content"])
+                etag = r.headers.get("ETag")
+                _remember_state(state, etag)
+                _save_local_state(state, etag)
+                return state
             except Exception:
                 pass
+    # гист не дал стейт (файла нет / битый / не 200-304): кэш больше не описывает гист —
+    # сбрасываем, иначе hash-guard в save_state сочтёт новый стейт "неизменным" и не запишет его
+    log(f"Gist state unavailable (HTTP {r.status_code}) -> start from empty state")
+    _GIST_CACHE.update(etag=None, state=None, hash=None)
     return {"date": kyiv_today_str(), "rows": {}}
 
-def save_state(state: Dict):
-    url = f"https://api.github.com/gists/{GIST_ID}"
-    files = {GIST_FILENAME: {"content": json.dumps(state, ensure_ascii=False, indent=2)}}
-    r = requests.patch(url, headers={
-        "Authorization": f"Bearer {GIST_TOKEN}",
-        "Accept": "application/vnd.github+json"
-    }, json={"files": files}, timeout=30)
+GITHUB_RATE_WAIT_MAX = 60.0
+
+def _github_rate_wait(r) -> bool:
+    # исчерпан rate limit GitHub: если сброс скоро — ждём до X-RateLimit-Reset и пробуем ещё раз.
+    # Вторичный лимит приходит с Retry-After — ждём ровно его
+    if r.status_code not in (403, 429):
+        return False
+    try:
+        if r.headers.get("Retry-After"):
+            wait = float(r.headers["Retry-After"])
+        elif r.headers.get("X-RateLimit-Remaining") == "0":
+            wait = float(r.headers.get("X-RateLimit-Reset", "0")) - time.time() + 1
+        else:
+            return False
+    except ValueError:
+        return False
+    if wait <= 0 or wait > GITHUB_RATE_WAIT_MAX:
+        return False
+    log(f"GitHub rate limit -> wait {wait:.0f}s")
+    time.sleep(wait)
+    return True
+
+def save_state(state: Dict) -> bool:
+    # тот же контент, что уже лежит в гисте, — PATCH не шлём
+    if state_hash(state) == _GIST_CACHE["hash"]:
+        log("State unchanged -> skip save")
+        return False
+    files = {GIST_FILENAME: {"content": encode_state(state)}}
+    body = json_bytes({"files": files})
+    for _ in range(2):
+        r = GH_SESSION.patch(GIST_URL, headers={"Content-Type": "application/json"}, data=body, timeout=30)
+        if not _github_rate_wait(r):
+            break
     r.raise_for_status()
+    # то, что записали, и есть актуальная версия гиста
+    etag = r.headers.get("ETag")
+    _remember_state(state, etag)
+    _save_local_state(state, etag)
+    return True
 
 
 # ================= parsing (Favourite schema) =================
-def parse_rows_from_payload(payload: dict) -> List[Dict]:
-    rows: List[Dict] = []
-    for r in payload.get("rows", []):
-        dims = r.get("dimensions", {}) if isinstance(r.get("dimensions"), dict) else {}
-
-        def g(k):
-            return r.get(k) or dims.get(k) or ""
-
-        campaign = str(g("campaign")).strip()
-        country  = str(g("country")).strip()
-        external = str(g("external_id")).strip()
-        creative = str(g("creative_id")).strip()
+@dataclass(slots=True)
+class Row:
+    # slots: без per-row __dict__ — меньше памяти и быстрее доступ к полям, чем у dict
+    k: str
+    campaign: str
+    country: str
+    external_id: str
+    creative_id: str
+    conversions: int
+    sales: int
+    revenue: float
+
+def parse_rows_from_payload(payload: dict) -> List[Row]:
+    rows: List[Row] = []
+    append = rows.append
+    for r in payload.get("rows", ()):
+        dims = r.get("dimensions")
+        if not isinstance(dims, dict):
+            dims = {}
+        get = r.get
+        dget = dims.get
+
+        # campaign/country/creative повторяются в сотнях строк — интернируем, чтобы был один объект;
+        # external_id почти уникален — его интернировать смысла нет
+        campaign = sys.intern(str(get("campaign") or dget("campaign") or "").strip())
+        country  = sys.intern(str(get("country") or dget("country") or "").strip())
+        external = str(get("external_id") or dget("external_id") or "").strip()
+        creative = sys.intern(str(get("creative_id") or dget("creative_id") or "").strip())
 
         # пропускаем мусорные строки
         if not (campaign or country or external or creative):
             continue
 
-        rows.append({
-            "k": f"{campaign}|{country}|{external}|{creative}",
-            "campaign": campaign,
-            "country": country,
-            "external_id": external,
-            "creative_id": creative,
-            "conversions": as_int(r.get("conversions")),
-            "sales": as_int(r.get("sales")),
-            "revenue": as_float(r.get("sale_revenue") or r.get("deposit_revenue") or r.get("revenue")),
-        })
+        # числа из API почти всегда уже int/float — try/except as_* только для строк
+        conv = get("conversions")
+        sales = get("sales")
+        rev = get("sale_revenue") or get("deposit_revenue") or get("revenue")
+
+        append(Row(
+            "|".join((campaign, country, external, creative)),
+            campaign,
+            country,
+            external,
+            creative,
+            conv if type(conv) is int else as_int(conv),
+            sales if type(sales) is int else as_int(sales),
+            rev if type(rev) is float else as_float(rev),
+        ))
     return rows
 
-def aggregate_rows_max(rows: List[Dict]) -> List[Dict]:
-    acc: Dict[str, Dict] = {}
-    for r in rows:
-        k = r["k"]
-        if k not in acc:
-            acc[k] = dict(r)
+_DIM_FIELDS = ("campaign", "country", "external_id", "creative_id")
+
+def _row_has_dims(r: dict) -> bool:
+    # тот же фильтр мусора, что в parse_rows_from_payload: строка без единого разреза — не строка отчёта
+    dims = r.get("dimensions")
+    if not isinstance(dims, dict):
+        dims = {}
+    for f in _DIM_FIELDS:
+        v = r.get(f) or dims.get(f)
+        if v and str(v).strip():
+            return True
+    return False
+
+def payload_score(raw_rows: list) -> float:
+    # та же оценка, что по Row (строки + 0.01 * (conv + sales)), но по сырым dict — без парсинга.
+    # Считаем только строки с разрезами: список {"id","name"} из чужого эндпоинта даёт 0
+    n = 0
+    total = 0
+    for r in raw_rows:
+        if not isinstance(r, dict) or not _row_has_dims(r):
+            continue
+        n += 1
+        c = r.get("conversions")
+        s = r.get("sales")
+        total += (c if type(c) is int else as_int(c)) + (s if type(s) is int else as_int(s))
+    return n + 0.01 * total if n else 0.0
+
+# в стейте храним только метрики: {k: [conversions, sales, revenue]}
+def compact_rows(rows: List[Row]) -> Dict[str, List]:
+    return {r.k: [r.conversions, r.sales, r.revenue] for r in rows}
+
+def prev_metrics(prev_rows: Dict) -> Dict[str, List]:
+    # компактный формат ({k: [int, int, float]}) берём как есть: поверхностная копия dict,
+    # списки общие со стейтом (main их не мутирует, а заменяет). Новые списки — только для
+    # старых гистов, где лежала строка целиком, и для значений с кривыми типами
+    out: Dict[str, List] = dict(prev_rows)
+    for k, v in prev_rows.items():
+        if type(v) is list and len(v) == 3:
+            c, s, rv = v
+            if type(c) is int and type(s) is int and type(rv) in (float, int):
+                continue
+            out[k] = [as_int(c), as_int(s), as_float(rv)]
+        elif isinstance(v, dict):
+            out[k] = [as_int(v.get("conversions")), as_int(v.get("sales")), as_float(v.get("revenue"))]
+        elif isinstance(v, (list, tuple)) and len(v) >= 3:
+            out[k] = [as_int(v[0]), as_int(v[1]), as_float(v[2])]
         else:
-            a = acc[k]
-            a["conversions"] = max(a.get("conversions", 0), r.get("conversions", 0))
-            a["sales"] = max(a.get("sales", 0), r.get("sales", 0))
-            a["revenue"] = max(a.get("revenue", 0.0), r.get("revenue", 0.0))
+            del out[k]
+    return out
+
+def aggregate_rows_max(rows: List[Row]) -> List[Row]:
+    # строки свежие из парсера — первую берём как есть (без копии), дубли вливаем на месте
+    acc: Dict[str, Row] = {}
+    for r in rows:
+        k = r.k
+        a = acc.get(k)
+        if a is None:
+            acc[k] = r
+            continue
+        if r.conversions > a.conversions:
+            a.conversions = r.conversions
+        if r.sales > a.sales:
+            a.sales = r.sales
+        if r.revenue > a.revenue:
+            a.revenue = r.revenue
     return list(acc.values())
 
 
-# ================= FETCH (старый стиль: ловим любые JSON rows) =================
-def fetch_rows() -> List[Dict]:
-    with sync_playwright() as pw:
-        browser = pw.chromium.launch(
-            headless=True,
-            args=["--disable-blink-features=AutomationControlled"]
-        )
-        ctx = browser.new_context(
-            viewport={"width": 1400, "height": 900},
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124 Safari/537.36"
+# ================= BROWSER POOL =================
+# отчёту нужны только document/script/xhr — картинки, шрифты, стили и аналитику режем.
+# Если без CSS кнопки Refresh/Apply перестанут кликаться — убрать stylesheet через env
+BLOCKED_RESOURCE_TYPES = frozenset(
+    t.strip() for t in os.getenv(
+        "BLOCKED_RESOURCE_TYPES", "image,font,media,stylesheet,texttrack,manifest"
+    ).split(",") if t.strip()
+)
+BLOCKED_URL_RE = re.compile(
+    r"\.(?:png|jpe?g|gif|webp|svg|ico|woff2?|ttf|otf|mp4|webm)(?:\?|$)",
+    re.I
+)
+# трекеры/виджеты режутся и при BLOCK_THIRD_PARTY=0 (когда бандлы админки идут с CDN).
+# Сверяется только хост чужих запросов — свои /assets/sentry.*.js и т.п. не трогаем
+BLOCKED_HOST_RE = re.compile(
+    r"google-analytics|googletagmanager|doubleclick|sentry|hotjar|clarity\.ms"
+    r"|mc\.yandex|connect\.facebook|intercom|segment\.(?:io|com)|fonts\.googleapis",
+    re.I
+)
+
+# всё, что не с домена Keitaro (CDN-трекеры, виджеты), отчёту не нужно
+BLOCK_THIRD_PARTY = (os.getenv("BLOCK_THIRD_PARTY", "1") == "1")
+
+def _site(host) -> str:
+    # хост без схемы/порта и без "www." — редирект http→https или на www. остаётся своим
+    host = (host or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+APP_SITE = _site(pu.hostname)
+
+def _is_third_party(url: str) -> bool:
+    u = urlparse(url)
+    # data:/blob: и пр. — не сетевые запросы к чужим хостам
+    if u.scheme not in ("http", "https"):
+        return False
+    return _site(u.hostname) != APP_SITE
+
+def _is_tracker(url: str) -> bool:
+    return _is_third_party(url) and bool(BLOCKED_HOST_RE.search(urlparse(url).hostname or ""))
+
+def _route_filter(route):
+    req = route.request
+    url = req.url
+    if (
+        req.resource_type in BLOCKED_RESOURCE_TYPES
+        or BLOCKED_URL_RE.search(url)
+        or (_is_third_party(url) if BLOCK_THIRD_PARTY else _is_tracker(url))
+    ):
+        route.abort()
+    else:
+        route.continue_()
+
+LAUNCH_ARGS = [
+    "--disable-blink-features=AutomationControlled",
+    "--no-sandbox",
+    "--no-zygote",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--blink-settings=imagesEnabled=false",
+    "--disable-features=IsolateOrigins,site-per-process",
+]
+CONTEXT_OPTS = dict(
+    viewport={"width": 1400, "height": 900},
+    user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124 Safari/537.36"
+)
+
+class BrowserPool:
+    """Один Chromium на процесс: стартуем лениво, между тиками держим тёплым."""
+    _pw = None
+    _browser = None
+    _ctx = None
+    _context_uses = 0
+    _context_born = 0.0
+    _from_storage = False
+
+    @classmethod
+    def playwright(cls):
+        if cls._pw is None:
+            cls._pw = sync_playwright().start()
+        return cls._pw
+
+    @classmethod
+    def browser(cls):
+        if cls._browser is None or not cls._browser.is_connected():
+            # headless=True в Playwright 1.55 = лёгкий chromium-headless-shell (channel не задаём)
+            cls._browser = cls.playwright().chromium.launch(headless=True, args=LAUNCH_ARGS)
+            log("Browser launched")
+        return cls._browser
+
+    @classmethod
+    def context(cls):
+        expired = (
+            cls._context_uses >= CONTEXT_MAX_USES
+            or (time.time() - cls._context_born) >= CONTEXT_MAX_AGE
         )
-        page = ctx.new_page()
+        if cls._ctx is not None and expired:
+            log(f"Recycle context (uses={cls._context_uses})")
+            cls.close_context()
+        if cls._ctx is None:
+            cls._ctx = cls._new_context()
+            # с route() Playwright выключает HTTP-кэш — в режиме профиля ради кэша бандлов
+            # перехват не ставим (картинки и так режет --blink-settings=imagesEnabled=false)
+            if not BROWSER_PROFILE_DIR:
+                cls._ctx.route("**/*", _route_filter)
+            cls._context_uses = 0
+            cls._context_born = time.time()
+        cls._context_uses += 1
+        return cls._ctx
+
+    @classmethod
+    def _new_context(cls):
+        # профиль на диске: куки, localStorage и HTTP-кэш бандлов админки переживают перезапуск
+        if BROWSER_PROFILE_DIR:
+            warm = os.path.isdir(BROWSER_PROFILE_DIR) and bool(os.listdir(BROWSER_PROFILE_DIR))
+            ctx = cls.playwright().chromium.launch_persistent_context(
+                BROWSER_PROFILE_DIR, headless=True, args=LAUNCH_ARGS, **CONTEXT_OPTS
+            )
+            log(f"Persistent profile {'reused' if warm else 'created'}: {BROWSER_PROFILE_DIR}")
+            cls._from_storage = warm
+            return ctx
+        # сохранённые куки прошлого логина — форма логина, скорее всего, не понадобится
+        if os.path.exists(STORAGE_STATE_PATH):
+            try:
+                ctx = cls.browser().new_context(storage_state=STORAGE_STATE_PATH, **CONTEXT_OPTS)
+                cls._from_storage = True
+                return ctx
+            except Exception as e:
+                log(f"Storage state ignored: {e!r}")
+        cls._from_storage = False
+        return cls.browser().new_context(**CONTEXT_OPTS)
+
+    @classmethod
+    def has_session(cls) -> bool:
+        # контекст из storage_state или уже отработавший тик — куки, скорее всего, живые
+        return cls._from_storage or cls._context_uses > 1
+
+    @classmethod
+    def close_context(cls):
+        try:
+            if cls._ctx is not None:
+                cls._ctx.close()
+        except Exception:
+            pass
+        cls._ctx = None
+
+    @classmethod
+    def close(cls):
+        cls.close_context()
+        try:
+            if cls._browser is not None:
+                cls._browser.close()
+        except Exception:
+            pass
+        try:
+            if cls._pw is not None:
+                cls._pw.stop()
+        except Exception:
+            pass
+        cls._browser = None
+        cls._pw = None
 
-        log(f"BASE_URL = {BASE_URL}")
-        log("Open login page")
-        page.goto(f"{BASE_URL}/admin/", wait_until="domcontentloaded")
 
-        # логин (универсально)
+atexit.register(BrowserPool.close)
+
+
+# ================= FETCH (старый стиль: ловим любые JSON rows) =================
+# XHR отчёта Keitaro — ждём именно его, а не фиксированные паузы.
+# Пути Keitaro всегда в нижнем регистре — сравниваем подстроку как есть, без .lower()
+REPORT_API_MARK = os.getenv("REPORT_API_MARK", "/admin/api/reports/")
+REPORT_WAIT_MS = 15000
+WAIT_STEP_MS = 100
+# меньше не уместить даже {"rows":[{"campaign":"x"}]}
+MIN_REPORT_BYTES = 24
+# кнопка логина во всех локалях админки; новые локали — сюда
+LOGIN_BTN_RE = re.compile(r"sign in|log in|login|войти|увійти", re.I)
+LOGIN_FORM_SEL = "app-login, input[type='password']"
+LOGIN_FORM_WAIT_MS = 8000
+
+def _is_report_response(resp) -> bool:
+    return REPORT_API_MARK in resp.url and resp.ok
+
+def fetch_rows() -> List[Row]:
+    page = BrowserPool.context().new_page()
+    try:
+        return _fetch_rows(page)
+    except Exception:
+        # таймаут/навигация/упавшая вкладка — следующий тик начнём с чистого контекста,
+        # сам Chromium не перезапускаем (он поднимется заново, только если умер)
+        log("Fetch failed -> drop context")
+        BrowserPool.close_context()
+        raise
+    finally:
+        # закрываем только страницу — контекст (куки) и браузер живут до рецикла
         try:
-            if page.locator("input[placeholder='Username']").count() > 0:
-                page.get_by_placeholder("Username").fill(LOGIN_USER)
-                page.get_by_placeholder("Password").fill(LOGIN_PASS)
-                page.get_by_role("button", name=re.compile("sign in|войти|увійти", re.I)).click()
-            else:
-                page.fill("input[name='login'], input[type='text']", LOGIN_USER)
-                page.fill("input[name='password'], input[type='password']", LOGIN_PASS)
-                page.get_by_role("button", name=re.compile("sign in|войти|увійти", re.I)).click()
+            page.close()
         except Exception:
             pass
 
-        # ждём, что логин-форма исчезнет / роут сменится
+def _login(page):
+    log("Open login page")
+    page.goto(f"{BASE_URL}/admin/", wait_until="domcontentloaded")
+
+    # сессия ещё жива (storage_state / тёплый контекст) — формы не будет; без этой
+    # проверки fill() ждал бы поле по 30 с, а потом ещё app-login detached
+    try:
+        page.wait_for_selector(LOGIN_FORM_SEL, timeout=LOGIN_FORM_WAIT_MS)
+    except PWTimeout:
+        log("No login form -> session alive, skip login")
+        return
+
+    # логин (универсально)
+    try:
+        if page.locator("input[placeholder='Username']").count() > 0:
+            page.get_by_placeholder("Username").fill(LOGIN_USER)
+            page.get_by_placeholder("Password").fill(LOGIN_PASS)
+            page.get_by_role("button", name=LOGIN_BTN_RE).click()
+        else:
+            page.fill("input[name='login'], input[type='text']", LOGIN_USER)
+            page.fill("input[name='password'], input[type='password']", LOGIN_PASS)
+            page.get_by_role("button", name=LOGIN_BTN_RE).click()
+    except Exception:
+        pass
+
+    # ждём, что логин-форма исчезнет / роут сменится
+    try:
+        page.wait_for_selector("app-login", state="detached", timeout=15000)
+        log("Logged in (app-login detached)")
+    except PWTimeout:
+        # бывает, что app-login не отцепляется, но сессия есть — продолжаем
+        log("Login wait timeout (continue)")
+
+def _open_report(page, ready=_is_report_response) -> bool:
+    # открываем отчёт и сразу ждём его XHR (вместо слепого wait_for_timeout)
+    log("Open report page")
+    try:
+        with page.expect_response(ready, timeout=REPORT_WAIT_MS):
+            page.goto(PAGE_URL, wait_until="domcontentloaded")
+        log("Report XHR arrived on open")
+        return True
+    except PWTimeout:
+        log("Report XHR not seen on open")
+        return False
+
+def _click_for_report(page, sel: str, ready=_is_report_response) -> bool:
+    # True — кнопка нажата; если XHR отчёта ушёл, к выходу он уже пришёл (без поллинга)
+    clicked = False
+    try:
+        with page.expect_response(ready, timeout=REPORT_WAIT_MS):
+            page.click(sel, timeout=2500)
+            clicked = True
+            log(f"Clicked: {sel}")
+    except Exception:
+        pass
+    return clicked
+
+def _fetch_rows(page) -> List[Row]:
+    log(f"BASE_URL = {BASE_URL}")
+
+    best_payload = None
+    best_score = -1.0
+    best_req = None
+    done = False
+
+    def on_response(resp):
+        nonlocal best_payload, best_score, best_req, done
+        # ответ самого эндпоинта отчёта уже пойман — остальное не разбираем
+        if done:
+            return
+        # как в старом рабочем стиле: НЕ фильтруем URL, берём любой JSON с rows.
+        # Но тело тянем только у XHR/fetch — документ, скрипты и пр. отчётом не бывают,
+        # а каждый resp.body() — отдельный round-trip в браузер
+        if resp.request.resource_type not in ("xhr", "fetch"):
+            return
+        # заголовки уже пришли вместе с событием — отсекаем не-JSON до запроса тела
+        headers = resp.headers
+        if "json" not in headers.get("content-type", ""):
+            return
+        # пустые ответы ({}, [], {"ok":true}) отчётом быть не могут; без длины (chunked) — тянем
+        clen = headers.get("content-length")
+        if clen is not None and clen.isdigit() and int(clen) < MIN_REPORT_BYTES:
+            return
         try:
-            page.wait_for_selector("app-login", state="detached", timeout=15000)
-            log("Logged in (app-login detached)")
-        except PWTimeout:
-            # бывает, что app-login не отцепляется, но сессия есть — продолжаем
-            log("Login wait timeout (continue)")
-
-        captured: List[Dict] = []
-        best_score = -1.0
-
-        def on_response(resp):
-            nonlocal captured, best_score
-            # как в старом рабочем стиле: НЕ фильтруем URL, берём любой JSON с rows
-            try:
-                data = resp.json()
-            except Exception:
-                return
-            if not isinstance(data, dict):
-                return
-            rr = data.get("rows")
-            if not isinstance(rr, list) or not rr:
-                return
-
-            rows = parse_rows_from_payload(data)
-            if not rows:
-                return
-
-            # "лучший пакет" — по наполненности
-            score = len(rows) + 0.01 * sum((x.get("conversions", 0) + x.get("sales", 0)) for x in rows)
-            if score > best_score:
-                best_score = score
-                captured = rows
-                log(f"XHR captured: rows={len(rows)} score={best_score:.2f}")
-
-        ctx.on("response", on_response)
-
-        # открываем отчёт
-        log("Open report page")
-        page.goto(PAGE_URL, wait_until="domcontentloaded")
-        page.wait_for_timeout(1500)
-
-        # 🔥 ФОРСИМ загрузку отчёта (иначе XHR может не уйти)
+            data = json_loads(resp.body())
+        except Exception:
+            return
+        if not isinstance(data, dict):
+            return
+        rr = data.get("rows")
+        if not isinstance(rr, list) or not rr:
+            return
+
+        # "лучший пакет" — по наполненности; Row строим один раз, только для победителя
+        score = payload_score(rr)
+        if score <= 0:
+            return
+        is_report = _is_report_response(resp)
+        # ответ эндпоинта отчёта выигрывает всегда — посторонний JSON его не перебьёт
+        if is_report or score > best_score:
+            best_score = score
+            best_payload = data
+            best_req = resp.request
+            log(f"XHR captured: rows={len(rr)} score={best_score:.2f}")
+            if is_report:
+                done = True
+                # отчёт пойман — дальше Python-колбэки на каждый ответ не нужны вовсе
+                page.remove_listener("response", on_response)
+        else:
+            debug("XHR ignored: %s rows=%d score=%.2f", resp.url, len(rr), score)
+
+    # слушатель на странице, а не на контексте: умирает вместе с page.close()
+    page.on("response", on_response)
+
+    def report_ready(resp) -> bool:
+        # выходим на XHR отчёта или на любом JSON, который уже принял on_response
+        # (слушатель повешен раньше ожидания — к проверке best_payload уже обновлён)
+        return best_payload is not None or _is_report_response(resp)
+
+    # с живой сессией (storage_state / прошлый тик) сразу идём в отчёт, логин — только если XHR не пришёл
+    arrived = False
+    if BrowserPool.has_session():
+        arrived = _open_report(page, report_ready)
+    if not arrived:
+        _login(page)
+        arrived = _open_report(page, report_ready)
+
+    # 🔥 ФОРСИМ загрузку отчёта (иначе XHR может не уйти)
+    forced = arrived or best_payload is not None
+    if not forced:
         log("Try force Refresh/Apply")
-        forced = False
         # Refresh варианты
         for sel in [
             "button[aria-label='Refresh']",
@@ -241,68 +929,217 @@ def fetch_rows() -> List[Dict]:
             "button:has-text('Оновити')",
             "button:has-text('Обновить')",
         ]:
-            try:
-                page.click(sel, timeout=2500)
-                log(f"Clicked: {sel}")
+            if _click_for_report(page, sel, report_ready):
+                forced = True
+                break
+
+    # Apply варианты (на некоторых сборках отчёт грузится после Apply)
+    if not forced:
+        for sel in [
+            "button:has-text('Apply')",
+            "button:has-text('Застосувати')",
+            "button:has-text('Применить')",
+        ]:
+            if _click_for_report(page, sel, report_ready):
                 forced = True
                 break
-            except Exception:
-                pass
 
-        # Apply варианты (на некоторых сборках отчёт грузится после Apply)
-        if not forced:
-            for sel in [
-                "button:has-text('Apply')",
-                "button:has-text('Застосувати')",
-                "button:has-text('Применить')",
-            ]:
-                try:
-                    page.click(sel, timeout=2500)
-                    log(f"Clicked: {sel}")
-                    forced = True
-                    break
-                except Exception:
-                    pass
-
-        # ждём ответы
-        t0 = time.time()
-        while (time.time() - t0) < 12.0 and not captured:
-            page.wait_for_timeout(600)
+    def wait_captured(timeout_s: float) -> bool:
+        # sync Playwright раздаёт события только внутри своих вызовов, поэтому
+        # threading.Event.wait() тут не годится; мелкий шаг = выходим сразу после XHR
+        deadline = time.monotonic() + timeout_s
+        while best_payload is None and time.monotonic() < deadline:
+            page.wait_for_timeout(WAIT_STEP_MS)
+        return best_payload is not None
 
+    # ждём ответы (после клика/открытия XHR уже дождались — тут только догоняем обработчик)
+    if not wait_captured(3.0 if forced else 12.0):
         # если не поймали — пробуем reload (как в старых хаках)
-        if not captured:
-            log("No XHR yet -> reload")
-            try:
+        log("No XHR yet -> reload")
+        try:
+            with page.expect_response(report_ready, timeout=REPORT_WAIT_MS):
                 page.reload(wait_until="domcontentloaded")
-            except Exception:
-                pass
-            page.wait_for_timeout(2500)
-
-            # ещё ждём
-            t1 = time.time()
-            while (time.time() - t1) < 10.0 and not captured:
-                page.wait_for_timeout(600)
-
-        browser.close()
+        except Exception:
+            pass
+        # XHR отчёта пришёл, но обработчик мог ещё не разобрать тело
+        wait_captured(1.0)
+
+    captured = parse_rows_from_payload(best_payload) if best_payload is not None else []
+    if not captured:
+        log("Result: captured=0")
+        return []
+
+    log(f"Result: captured={len(captured)}")
+    if best_req is not None:
+        _save_replay(page, best_req)
+    return aggregate_rows_max(captured)
+
+
+# ================= DIRECT (без браузера) =================
+# отдельная сессия: куки Keitaro не должны уходить в Telegram/GitHub
+KT_SESSION = requests.Session()
+KT_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+def _write_private(path: str, text: str):
+    # куки админки и заголовки XHR — только владельцу (0600), в общем /tmp их не должен читать никто
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        # mode у os.open действует только при создании — старый файл с 0644 дожимаем явно
+        os.fchmod(f.fileno(), 0o600)
+        f.write(text)
+
+def _save_replay(page, req):
+    try:
+        storage = page.context.storage_state()
+        headers = {k: v for k, v in req.headers.items() if k.lower() not in ("cookie", "content-length")}
+        request = {
+            "date": kyiv_today_str(),
+            "method": req.method,
+            "url": req.url,
+            "body": req.post_data,
+            "headers": headers,
+        }
+        _write_private(STORAGE_STATE_PATH, json_dumps(storage))
+        _write_private(REPORT_REQUEST_PATH, json_dumps(request))
+        if SESSION_IN_GIST:
+            content = json_dumps({"storage": storage, "request": request})
+            r = GH_SESSION.patch(GIST_URL, headers={"Content-Type": "application/json"},
+                              data=json_bytes({"files": {SESSION_GIST_FILENAME: {"content": content}}}),
+                              timeout=30)
+            r.raise_for_status()
+    except Exception as e:
+        log(f"Replay not saved: {e!r}")
+
+def _restore_session():
+    # холодный старт (Actions): локальных файлов нет — подтягиваем сессию из гиста
+    if not SESSION_IN_GIST or os.path.exists(STORAGE_STATE_PATH):
+        return
+    try:
+        r = GH_SESSION.get(GIST_URL, timeout=30)
+        if r.status_code != 200:
+            return
+        f = json_loads(r.content).get("files", {}).get(SESSION_GIST_FILENAME) or {}
+        data = json_loads(f["content"]) if f.get("content") else None
+        if not isinstance(data, dict):
+            return
+        _write_private(STORAGE_STATE_PATH, json_dumps(data.get("storage") or {}))
+        _write_private(REPORT_REQUEST_PATH, json_dumps(data.get("request") or {}))
+        log("Session restored from gist")
+    except Exception as e:
+        log(f"Session not restored: {e!r}")
+
+def _drop_session():
+    # сессия протухла: без storage_state браузер сразу пойдёт логиниться, без 15 с ожидания
+    for path in (STORAGE_STATE_PATH, REPORT_REQUEST_PATH):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
-        if not captured:
-            log("Result: captured=0")
-            return []
+def _report_request():
+    if REPORT_API_URL:
+        return {
+            "method": "POST" if REPORT_API_BODY else "GET",
+            "url": REPORT_API_URL,
+            "body": REPORT_API_BODY or None,
+            "headers": {"Content-Type": "application/json"} if REPORT_API_BODY else {},
+        }
+    rq = _read_json_file(REPORT_REQUEST_PATH)
+    # тело XHR может нести явный диапазон дат — вчерашний запрос не переигрываем
+    if not isinstance(rq, dict) or rq.get("date") != kyiv_today_str():
+        return None
+    return rq
+
+def fetch_rows_direct() -> List[Row]:
+    rq = _report_request()
+    st = _read_json_file(STORAGE_STATE_PATH)
+    if rq is None or not isinstance(st, dict):
+        return []
+
+    KT_SESSION.cookies.clear()
+    for c in st.get("cookies", []):
+        KT_SESSION.cookies.set(c["name"], c["value"], domain=c.get("domain"), path=c.get("path", "/"))
 
-        log(f"Result: captured={len(captured)}")
-        return aggregate_rows_max(captured)
+    try:
+        r = KT_SESSION.request(
+            rq.get("method", "GET"), rq["url"],
+            data=rq.get("body"), headers=rq.get("headers") or {}, timeout=30
+        )
+    except Exception as e:
+        log(f"Direct fetch failed: {e!r}")
+        return []
+    if r.status_code != 200:
+        # 401/403 — сессия протухла, дальше пойдёт браузер с логином
+        log(f"Direct fetch: HTTP {r.status_code}")
+        if r.status_code in (401, 403):
+            _drop_session()
+        return []
+    try:
+        data = json_loads(r.content)
+    except Exception:
+        log("Direct fetch: not JSON (session expired?)")
+        return []
+    rows = parse_rows_from_payload(data) if isinstance(data, dict) else []
+    log(f"Direct fetch: rows={len(rows)}")
+    return aggregate_rows_max(rows)
+
+def fetch_rows_api() -> List[Row]:
+    if not KEITARO_API_KEY:
+        return []
+    # без тела с фильтрами избранного report/build отдал бы ВСЕ кампании — алерты пошли бы по всему
+    if not KEITARO_REPORT_BODY:
+        log("API fetch skipped: KEITARO_API_KEY set, but KEITARO_REPORT_BODY is empty")
+        return []
+    try:
+        r = KT_SESSION.post(
+            f"{BASE_URL}/admin_api/v1/report/build",
+            data=KEITARO_REPORT_BODY.encode("utf-8"),
+            headers={"Api-Key": KEITARO_API_KEY, "Content-Type": "application/json"},
+            timeout=30,
+        )
+    except Exception as e:
+        log(f"API fetch failed: {e!r}")
+        return []
+    if r.status_code != 200:
+        log(f"API fetch: HTTP {r.status_code}")
+        return []
+    try:
+        data = json_loads(r.content)
+    except Exception:
+        log("API fetch: not JSON")
+        return []
+    # report/build отдаёт плоские rows с теми же именами полей — парсер тот же
+    rows = parse_rows_from_payload(data) if isinstance(data, dict) else []
+    log(f"API fetch: rows={len(rows)}")
+    return aggregate_rows_max(rows)
+
+def get_rows() -> List[Row]:
+    # API-ключ → переигранный XHR с куками → браузер
+    rows = fetch_rows_api()
+    if rows:
+        return rows
+    _restore_session()
+    rows = fetch_rows_direct()
+    if rows or not USE_BROWSER:
+        return rows
+    return fetch_rows()
 
 
 # ================= MAIN =================
 def main():
     log("Script started")
-
-    state = load_state()
-    prev_date = state.get("date", kyiv_today_str())
-    prev_rows: Dict[str, Dict] = state.get("rows", {})
+    # дата тика фиксируется один раз и ДО выборки: отчёт, снятый в 23:59:59, не должен
+    # лечь базой нового дня, если сравнение случится уже после полуночи
     today = kyiv_today_str()
 
-    rows = fetch_rows()
+    # гист грузим в фоне, пока браузер логинится и ловит отчёт — I/O перекрываются
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        state_f = ex.submit(load_state)
+        rows = get_rows()
+        state = state_f.result()
+
+    prev_date = state.get("date", today)
+    prev_rows: Dict = state.get("rows", {})
 
     # если Keitaro временно отдал пусто — НЕ спамим, если сегодня уже были данные
     if not rows:
@@ -317,78 +1154,81 @@ def main():
     # reset daily (Kyiv)
     if prev_date != today:
         log("New day -> baseline saved")
-        save_state({"date": today, "rows": {r["k"]: r for r in rows}})
+        save_state({"date": today, "rows": compact_rows(rows)})
         flush_debug_to_tg()
         return
 
-    new_map: Dict[str, Dict] = {}
+    # новый стейт = копия прошлого снимка + сдвинувшиеся строки: на тихом тике — одна копия dict
+    # и ни одного нового списка; списки строим только для изменившихся ключей.
+    # Пропавшие из отчёта ключи остаются — вернувшаяся строка не алертит как "новая"
+    new_map = prev_metrics(prev_rows)
+    changed: List[Tuple[Row, List]] = []
+    for r in rows:
+        old = new_map.get(r.k)
+        if old is None or old[0] != r.conversions or old[1] != r.sales or old[2] != r.revenue:
+            changed.append((r, old))
+    for r, _ in changed:
+        new_map[r.k] = [r.conversions, r.sales, r.revenue]
+
     conv_msgs: List[str] = []
     sale_msgs: List[str] = []
 
-    for r in rows:
-        k = r["k"]
-        old = prev_rows.get(k)
-
-        header = (
-            f"Campaign: {r['campaign']}\n"
-            f"Country: {r['country']}\n"
-            f"External: {r['external_id']}\n"
-            f"Creative: {r['creative_id']}"
-        )
+    for r, old in changed:
+        k = r.k
+        old_conv, old_sales, old_rev = old or (0, 0, 0.0)
+        conv_up = r.conversions > old_conv
+        sales_up = r.sales > old_sales
+        # сдвиг только в revenue или вниз — алерта нет, текст не собираем
+        if not (conv_up or sales_up):
+            continue
 
-        if old:
-            old_conv = as_int(old.get("conversions"))
-            old_sales = as_int(old.get("sales"))
-            old_rev = as_float(old.get("revenue"))
-
-            if r["conversions"] - old_conv > 0:
-                conv_msgs.append(
-                    "🟩 *CONVERSION ALERT*\n"
-                    f"{header}\n"
-                    f"Conversions: {old_conv} → {r['conversions']}"
-                )
-                log(f"Alert: conversions up for {k}")
-
-            if r["sales"] - old_sales > 0:
-                delta_rev = r["revenue"] - old_rev
-                sale_msgs.append(
-                    "🟦 *SALE ALERT*\n"
-                    f"{header}\n"
-                    f"Sales: {old_sales} → {r['sales']}\n"
-                    f"Revenue Δ: {fmt_money(delta_rev)}"
-                )
-                log(f"Alert: sales up for {k}")
-        else:
-            if r["conversions"] > 0:
-                conv_msgs.append(
-                    "🟩 *CONVERSION ALERT*\n"
-                    f"{header}\n"
-                    f"Conversions: 0 → {r['conversions']}"
-                )
-                log(f"Alert: new key conversions for {k}")
-
-            if r["sales"] > 0:
-                sale_msgs.append(
-                    "🟦 *SALE ALERT*\n"
-                    f"{header}\n"
-                    f"Sales: 0 → {r['sales']}\n"
-                    f"Revenue: {fmt_money(r['revenue'])}"
-                )
-                log(f"Alert: new key sales for {k}")
-
-        new_map[k] = r
-
-    blocks = conv_msgs + sale_msgs
-    if blocks:
-        tg_send("\n\n".join(blocks), markdown=True)
-        log(f"Sent alerts: {len(blocks)}")
+        if conv_up:
+            conv_msgs.append(alert_text(
+                "🟩 *CONVERSION ALERT*", r,
+                f"Conversions: {old_conv} → {r.conversions}",
+            ))
+            log(f"Alert: {'conversions up' if old else 'new key conversions'} for {k}")
+
+        if sales_up:
+            if old:
+                rev_line = f"Revenue Δ: {fmt_money(r.revenue - old_rev)}"
+            else:
+                rev_line = f"Revenue: {fmt_money(r.revenue)}"
+            sale_msgs.append(alert_text(
+                "🟦 *SALE ALERT*", r,
+                f"Sales: {old_sales} → {r.sales}",
+                rev_line,
+            ))
+            log(f"Alert: {'sales up' if old else 'new key sales'} for {k}")
+
+    batcher = AlertBatcher(markdown=True)
+    for m in conv_msgs + sale_msgs:
+        batcher.add(m)
+    if batcher:
+        n_alerts = len(batcher)
+        n_msgs = batcher.flush()
+        log(f"Sent alerts: {n_alerts} in {n_msgs} message(s)")
     else:
         log("No alerts (no deltas)")
 
-    save_state({"date": today, "rows": new_map})
-    log("State saved")
+    if save_state({"date": today, "rows": new_map}):
+        log("State saved")
     flush_debug_to_tg()
 
 
+def run_forever():
+    log(f"Loop mode: every {LOOP_INTERVAL}s")
+    while True:
+        try:
+            main()
+        except Exception as e:
+            # один упавший тик не должен ронять демона (и тёплый браузер)
+            log(f"Tick failed: {e!r}")
+        time.sleep(LOOP_INTERVAL)
+
+
 if __name__ == "__main__":
-    main()
+    if LOOP_INTERVAL > 0:
+        run_forever()
+    else:
+        main()